@@ -0,0 +1,243 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+""" Typed GameState for the UCT search, built by `python setup.py build_ext --inplace`.
+	It follows the GameState in main.py move for move, main.py falls back to that one
+	when this extension is not built.
+"""
+from collections import deque
+from libc.stdlib cimport rand, srand
+
+import numpy as np
+
+from snakepit.datatypes import Position
+from snakepit.robot_snake import RobotSnake
+
+
+# Directions encoded as 0..3, the opposite direction is always `d ^ 1`
+DIRECTIONS = (RobotSnake.RIGHT, RobotSnake.LEFT, RobotSnake.DOWN, RobotSnake.UP)
+# Legal successors of each last direction, i.e. all moves except turning back
+NEXT_MOVES = tuple(tuple(DIRECTIONS[a] for a in range(4) if a != d ^ 1) for d in range(4))
+
+cdef int DX[4]
+cdef int DY[4]
+DX[:] = [1, -1, 0, 0]
+DY[:] = [0, 0, 1, -1]
+
+
+def seed(unsigned int value):
+	""" Seed the C random generator used by GameState.rollout.
+	"""
+	srand(value)
+
+
+cdef inline int direction_code(int xdir, int ydir):
+	if xdir == 1:
+		return 0
+	elif xdir == -1:
+		return 1
+	elif ydir == 1:
+		return 2
+	return 3
+
+
+cdef class GameState:
+	""" A state of the game. Bodies are kept as ring buffers of packed cells `x * size_y + y`
+		starting at the head, next to an occupancy bitboard indexed [x, y, player].
+	"""
+	cdef public int playerJustMoved
+	cdef readonly int size_x, size_y, n_players
+	cdef signed char[:, ::1] terrain
+	cdef unsigned char[:, :, ::1] occ
+	cdef int[:, ::1] ring
+	cdef int start[2]
+	cdef int length[2]
+	cdef int last_dir[2]
+	cdef int scores_[2]
+	cdef bint alive[2]
+
+	def __init__(self, terrain_codes, players):
+		cdef int p, i
+		self.playerJustMoved = 1 # At the root pretend the player just moved is player 2 - player 1 has the first move
+		self.terrain = np.ascontiguousarray(terrain_codes, dtype = np.int8)
+		self.size_x, self.size_y = self.terrain.shape[0], self.terrain.shape[1]
+		self.n_players = len(players)
+		self.occ = np.zeros((self.size_x, self.size_y, 2), dtype = np.uint8)
+		self.ring = np.zeros((2, self.size_x * self.size_y), dtype = np.intc)
+		for p in range(2):
+			self.start[p] = 0
+			self.length[p] = 0
+			self.last_dir[p] = -1
+			self.scores_[p] = 0
+			self.alive[p] = True
+		for p, body in enumerate(players):
+			for i, position in enumerate(body):
+				self.ring[p, i] = position.x * self.size_y + position.y
+				self.occ[position.x, position.y, p] = 1
+			self.length[p] = len(body)
+
+	cpdef GameState clone(self):
+		""" Clone this game state, the terrain is shared.
+		"""
+		cdef GameState st = GameState.__new__(GameState)
+		cdef int p
+		st.playerJustMoved = self.playerJustMoved
+		st.size_x = self.size_x
+		st.size_y = self.size_y
+		st.n_players = self.n_players
+		st.terrain = self.terrain
+		st.occ = self.occ.copy()
+		st.ring = self.ring.copy()
+		for p in range(2):
+			st.start[p] = self.start[p]
+			st.length[p] = self.length[p]
+			st.last_dir[p] = self.last_dir[p]
+			st.scores_[p] = self.scores_[p]
+			st.alive[p] = self.alive[p]
+		return st
+
+	def do_move(self, move):
+		""" Update a state by carrying out the given move. Return the undo record for undo_move.
+		"""
+		return self.step(direction_code(move.xdir, move.ydir))
+
+	cpdef tuple step(self, int d):
+		""" Carry out the move encoded as direction code d, updates playerJustMoved.
+			The undo record ends with the evicted tail cell, or -1 when the body did not move.
+		"""
+		cdef int p, cap, head, x, y, tail, value
+		cdef int player_just_moved = self.playerJustMoved
+		if self.n_players > 1:
+			self.playerJustMoved = 1 - self.playerJustMoved
+		else:
+			self.playerJustMoved = 0
+		p = self.playerJustMoved
+		undo = (player_just_moved, p, self.last_dir[p], self.scores_[p], self.alive[p])
+		self.last_dir[p] = d
+
+		cap = self.size_x * self.size_y
+		head = self.ring[p, self.start[p]]
+		x = head // self.size_y + DX[d]
+		y = head % self.size_y + DY[d]
+		if x < 0 or y < 0 or x >= self.size_x or y >= self.size_y or self.occ[x, y, 0] or self.occ[x, y, 1]:
+			self.scores_[p] -= 1000
+			self.alive[p] = False
+			return undo + (-1,)
+
+		value = self.terrain[x, y]
+		if value < 0:
+			self.scores_[p] -= 1000
+			self.alive[p] = False
+		else:
+			self.scores_[p] += value
+
+		self.occ[x, y, p] = 1
+		self.start[p] = (self.start[p] + cap - 1) % cap
+		self.ring[p, self.start[p]] = x * self.size_y + y
+		tail = self.ring[p, (self.start[p] + self.length[p]) % cap]
+		self.occ[tail // self.size_y, tail % self.size_y, p] = 0
+		return undo + (tail,)
+
+	def undo_move(self, undo):
+		""" Take back a move, undo is the record returned by do_move (or rollout).
+			Moves must be undone in the reverse order.
+		"""
+		cdef int p, cap, head, tail
+		player_just_moved, p, last_dir, score, alive, tail = undo
+		self.playerJustMoved = player_just_moved
+		self.last_dir[p] = last_dir
+		self.scores_[p] = score
+		self.alive[p] = alive
+		if tail >= 0:
+			cap = self.size_x * self.size_y
+			head = self.ring[p, self.start[p]]
+			self.occ[head // self.size_y, head % self.size_y, p] = 0
+			self.start[p] = (self.start[p] + 1) % cap
+			self.ring[p, (self.start[p] + self.length[p] - 1) % cap] = tail
+			self.occ[tail // self.size_y, tail % self.size_y, p] = 1
+
+	cpdef list rollout(self, int maxdepth):
+		""" Play up to maxdepth random moves from this state, or until a player dies, return their undo records.
+		"""
+		cdef int j, p, d
+		undo = []
+		for j in range(maxdepth):
+			if not (self.alive[0] and self.alive[1]):
+				break # a death decides the game
+			p = 1 - self.playerJustMoved if self.n_players > 1 else 0
+			if self.last_dir[p] < 0:
+				d = rand() % 4
+			else:
+				d = rand() % 3
+				if d >= self.last_dir[p] ^ 1:
+					d += 1
+			undo.append(self.step(d))
+		return undo
+
+	def get_moves(self):
+		""" Get all possible moves from this state.
+		"""
+		cdef int p = 1 - self.playerJustMoved if self.n_players > 1 else 0
+		if not self.alive[p]:
+			return ()
+		return DIRECTIONS if self.last_dir[p] < 0 else NEXT_MOVES[self.last_dir[p]]
+
+	cpdef int get_result(self, int playerjm):
+		""" Get the game result from the viewpoint of playerjm.
+		"""
+		return self.scores_[playerjm]
+
+	@property
+	def scores(self):
+		return [self.scores_[0], self.scores_[1]]
+
+	@property
+	def players_alive(self):
+		return [self.alive[0], self.alive[1]]
+
+	@property
+	def last_action(self):
+		return [DIRECTIONS[d] if d >= 0 else None for d in self.last_dir]
+
+	@last_action.setter
+	def last_action(self, actions):
+		cdef int p
+		for p in range(2):
+			self.last_dir[p] = -1 if actions[p] is None else direction_code(actions[p].xdir, actions[p].ydir)
+
+	@property
+	def bodies(self):
+		cdef int p, i, cell, cap = self.size_x * self.size_y
+		bodies = []
+		for p in range(self.n_players):
+			body = deque()
+			for i in range(self.length[p]):
+				cell = self.ring[p, (self.start[p] + i) % cap]
+				body.append(Position(cell // self.size_y, cell % self.size_y))
+			bodies.append(body)
+		return bodies
+
+	def __reduce__(self):
+		return (_restore, (np.asarray(self.terrain), np.asarray(self.occ), np.asarray(self.ring), self.playerJustMoved,
+			self.n_players, self.start, self.length, self.last_dir, self.scores, self.players_alive))
+
+	def __repr__(self):
+		return f'moved: {self.playerJustMoved}, players: {self.bodies}, score: {self.scores}, last_action: {self.last_action}'
+
+
+def _restore(terrain, occ, ring, player_just_moved, n_players, start, length, last_dir, scores, alive):
+	""" Unpickle a GameState, the worker processes of parallel_UCT receive their root state this way.
+	"""
+	cdef GameState st = GameState.__new__(GameState)
+	cdef int p
+	st.terrain = terrain
+	st.size_x, st.size_y = terrain.shape
+	st.n_players = n_players
+	st.occ = occ
+	st.ring = ring
+	st.playerJustMoved = player_just_moved
+	for p in range(2):
+		st.start[p] = start[p]
+		st.length[p] = length[p]
+		st.last_dir[p] = last_dir[p]
+		st.scores_[p] = scores[p]
+		st.alive[p] = alive[p]
+	return st
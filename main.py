@@ -1,7 +1,9 @@
 from typing import Tuple, List, Dict, Deque, Any, Optional
-from math import *
-import copy
+from math import sqrt, log
 from collections import deque
+import atexit
+import multiprocessing
+import os
 import random
 import time
 import traceback
@@ -9,6 +11,18 @@ import traceback
 from snakepit.robot_snake import RobotSnake
 from snakepit.datatypes import Position, Vector
 
+try:
+	import gamestate # typed GameState, built by `python setup.py build_ext --inplace`
+except ImportError:
+	gamestate = None
+else:
+	gamestate.seed(random.getrandbits(32)) # rand() would otherwise repeat the same rollouts in every game
+
+
+DEBUG = bool(os.environ.get('SNAKE_DEBUG')) # print the root children (or their merged visits) of every search
+
+# Offsets of the four neighbouring cells
+_DELTAS = ((1, 0), (-1, 0), (0, 1), (0, -1))
 
 
 class MyRobotSnake(RobotSnake):
@@ -53,20 +67,30 @@ class MyRobotSnake(RobotSnake):
 				assert tail == player[-1]
 
 		try:
-			state = GameState(self.world, self._players)
-			m = UCT(rootstate = state, itermax = 20, maxdepth = 4, verbose = False)
+			state = State(self._encode_terrain(), self._players)
+			# The first frame (also the only one of `run_robot.py --validate`) is searched in this process,
+			# the worker pool is started on the next one
+			search = UCT if initial else parallel_UCT
+			m = search(rootstate = state, itermax = 20, maxdepth = 4, verbose = False)
 			print('Sending', m)
 			return m
 		except Exception as ex:
 			traceback.print_exc(ex)
 
 
+	def _encode_terrain(self) -> List[List[int]]:
+		""" Encode the world as columns of terrain codes indexed [x][y]: food digits keep their value,
+			obstacles are -1 and everything else (including live snakes) is 0.
+		"""
+		codes = _TERRAIN_CODES
+		return [[codes.get(char, 0) for char, _ in column] for column in zip(*self.world)]
+
+
 	def _find_snake_heads(self):
 		player_head: Position = None
 		opponent_head: Position = None
-		for y in range(self.world.SIZE_Y):
-			for x in range(self.world.SIZE_X):
-				char, color = self.world[y][x]
+		for y, row in enumerate(self.world):
+			for x, (char, color) in enumerate(row):
 				if char == self.CH_HEAD:
 					if color == self.color:
 						player_head = Position(x, y)
@@ -78,19 +102,12 @@ class MyRobotSnake(RobotSnake):
 			return [deque([player_head])]
 
 
-	def _neighbours(self, position: Position):
-		return [
-			(position.x + 1, position.y),
-			(position.x - 1, position.y),
-			(position.x, position.y + 1),
-			(position.x, position.y - 1),
-		]
-
-
 	def _find_snake_rest(self, head: Position, is_player: bool):
 		def next(position: Position, previous: Position):
-			for x, y in self._neighbours(position):
-				if x != previous.x or y != previous.y:
+			for dx, dy in _DELTAS:
+				x = position.x + dx
+				y = position.y + dy
+				if (x != previous.x or y != previous.y) and 0 <= x < self.world.SIZE_X and 0 <= y < self.world.SIZE_Y:
 					char, color = self.world[y][x]
 					if (char == self.CH_BODY or char == self.CH_TAIL) and (color == self.color) == is_player:
 						return Position(x, y)
@@ -107,10 +124,16 @@ class MyRobotSnake(RobotSnake):
 
 
 	def _update_snake_part(self, old_position: Position, char_to_find: str, old_color: str):
-		for x, y in self._neighbours(old_position) + [Position(old_position.x, old_position.y)]:
-			char, color = self.world[y][x]
-			if char == char_to_find and color == old_color:
-				return Position(x, y)
+		for dx, dy in _DELTAS:
+			x = old_position.x + dx
+			y = old_position.y + dy
+			if 0 <= x < self.world.SIZE_X and 0 <= y < self.world.SIZE_Y:
+				char, color = self.world[y][x]
+				if char == char_to_find and color == old_color:
+					return Position(x, y)
+		char, color = self.world[old_position.y][old_position.x]
+		if char == char_to_find and color == old_color:
+			return old_position
 
 
 # This is a very simple implementation of the UCT Monte Carlo Tree Search algorithm in Python 2.7.
@@ -129,10 +152,21 @@ class MyRobotSnake(RobotSnake):
 # remains in any distributed code.
 #
 # For more information about Monte Carlo Tree Search check out our web site at www.mcts.ai
-Map = List[List[Tuple[str, str]]]
 Player = Deque[Position]
 Actions = {RobotSnake.UP, RobotSnake.DOWN, RobotSnake.LEFT, RobotSnake.RIGHT}
+ALL_MOVES = tuple(Actions)
+# Legal successors of each last move, i.e. all moves except turning back
+OPPOSITE_MOVES: Dict[Vector, Tuple[Vector, Vector, Vector]] = {
+	v: tuple(a for a in ALL_MOVES if a != Vector(-v.xdir, -v.ydir)) for v in ALL_MOVES
+}
 
+_BLOCK_CHARS = RobotSnake.DEAD_BODY_CHARS | {RobotSnake.CH_STONE}
+# Terrain codes of the world chars, all other chars are 0
+_TERRAIN_CODES: Dict[str, int] = {char: -1 for char in _BLOCK_CHARS}
+_TERRAIN_CODES.update((str(digit), digit) for digit in range(10))
+
+# Terrain code of the border which pads the board, so that leaving the board is just another terrain lookup
+OFF_BOARD = -2
 
 class GameState:
 	""" A state of the game, i.e. the game board. These are the only functions which are
@@ -140,11 +174,28 @@ class GameState:
 		zero-sum game, although they can be enhanced and made quicker, for example by using a
 		GetRandomMove() function to generate a random move during rollout.
 		By convention the players are numbered 0 and 1.
+		Cells are packed into ints `(x + 1) * stride + y + 1` of the board padded by an OFF_BOARD border,
+		Positions are only used at the boundary with snakepit.
 	"""
-	def __init__(self, terrain: Map, players: List[Player]) -> None:
+	__slots__ = ('playerJustMoved', 'terrain', 'stride', 'bodies', 'occ_bits', 'last_action', 'scores', 'players_alive')
+
+	def __init__(self, terrain_codes: List[List[int]], players: List[Player]) -> None:
 		self.playerJustMoved = 1 # At the root pretend the player just moved is player 2 - player 1 has the first move
-		self.terrain = terrain
-		self.players = players
+		self.stride = len(terrain_codes[0]) + 2
+		border = [OFF_BOARD] * self.stride
+		# A flat list of the padded columns, a plain list is the fastest to index from Python
+		self.terrain: List[int] = border.copy()
+		for column in terrain_codes:
+			self.terrain.append(OFF_BOARD)
+			self.terrain.extend(column)
+			self.terrain.append(OFF_BOARD)
+		self.terrain.extend(border)
+		self.bodies: List[Deque[int]] = [deque(self._cell(position) for position in player) for player in players]
+		# Occupied cells of all bodies as a bitset
+		self.occ_bits = 0
+		for body in self.bodies:
+			for cell in body:
+				self.occ_bits |= 1 << cell
 		self.last_action: List[Vector] = [None, None]
 		self.scores = [0, 0]
 		self.players_alive = [True, True]
@@ -152,7 +203,12 @@ class GameState:
 	def clone(self) -> 'GameState':
 		""" Clone this game state, don't deepcopy board.
 		"""
-		st = GameState(self.terrain, copy.deepcopy(self.players))
+		st = self.__class__.__new__(self.__class__)
+		st.playerJustMoved = self.playerJustMoved
+		st.terrain = self.terrain
+		st.stride = self.stride
+		st.bodies = [deque(b) for b in self.bodies]
+		st.occ_bits = self.occ_bits
 		st.last_action = self.last_action[:]
 		st.scores = self.scores[:]
 		st.players_alive = self.players_alive[:]
@@ -160,51 +216,83 @@ class GameState:
 
 	def do_move(self, move):
 		""" Update a state by carrying out the given move.
-			Must update playerJustMoved.
+			Must update playerJustMoved. Return the undo record for undo_move.
 		"""
-		if len(self.players) > 1:
+		player_just_moved = self.playerJustMoved
+		if len(self.bodies) > 1:
 			self.playerJustMoved = 1 - self.playerJustMoved
 			player_moving = self.playerJustMoved
 		else:
 			player_moving = 0
 			self.playerJustMoved = 0
+		undo = (player_just_moved, player_moving, self.last_action[player_moving],
+			self.scores[player_moving], self.players_alive[player_moving])
 		self.last_action[player_moving] = move
 
-		player = self.players[player_moving]
-		head = player[0]
-		new_head = Position(head.x + move.xdir, head.y + move.ydir)
+		new_head = self.bodies[player_moving][0] + move.xdir * self.stride + move.ydir
+		value = self.terrain[new_head]
 
-		char, color = self.terrain[new_head.y][new_head.x]
-		if self._collides_with_player(new_head):
+		if value == OFF_BOARD:
 			self.scores[player_moving] -= 1000
 			self.players_alive[player_moving] = False
-		elif char.isnumeric():
-			self.scores[player_moving] += int(char)
-		elif char in RobotSnake.DEAD_BODY_CHARS.union({RobotSnake.CH_STONE}):
+			return undo + (None,)
+		if self._collides_with_player(new_head):
 			self.scores[player_moving] -= 1000
 			self.players_alive[player_moving] = False
-		elif new_head.x == -1 or new_head.y == -1 or new_head.x == 41 or new_head.y == 41:
+			return undo + (None,)
+
+		if value < 0:
 			self.scores[player_moving] -= 1000
 			self.players_alive[player_moving] = False
+		else:
+			self.scores[player_moving] += value
 
+		return undo + (self._move_body(player_moving, new_head),)
 
-		player.appendleft(new_head)
-		player.pop()
+	def undo_move(self, undo):
+		""" Take back a move, undo is the record returned by do_move (or rollout).
+			Moves must be undone in the reverse order.
+		"""
+		self.playerJustMoved, player_moving, action, score, alive, tail = undo
+		self.last_action[player_moving] = action
+		self.scores[player_moving] = score
+		self.players_alive[player_moving] = alive
+		if tail is not None:
+			self._unmove_body(player_moving, tail)
+
+	def rollout(self, maxdepth):
+		""" Play up to maxdepth random moves from this state, or until a player dies, return their undo records.
+		"""
+		# Draw the random bits for the whole rollout at once and read them as base-12 digits. 12 is divisible
+		# by both 3 and 4, so `digit % len(moves)` is uniform; the 32 spare bits keep the bias below 2**-32.
+		rolls = random.getrandbits(4 * maxdepth + 32)
+		multiplayer = len(self.bodies) > 1
+		undo = []
+		alive = self.players_alive
+		for j in range(maxdepth):
+			if not (alive[0] and alive[1]):
+				break # while state is non-terminal, a death decides the game
+			player_moving = 1 - self.playerJustMoved if multiplayer else 0
+			rolls, roll = divmod(rolls, 12)
+			last_action = self.last_action[player_moving]
+			if last_action is None:
+				undo.append(self.do_move(ALL_MOVES[roll % 4]))
+			else:
+				undo.append(self.do_move(OPPOSITE_MOVES[last_action][roll % 3]))
+		return undo
 
 	def get_moves(self):
 		""" Get all possible moves from this state.
 		"""
 		# TODO: don't return moves leading to dying
-		if len(self.players) > 1:
+		if len(self.bodies) > 1:
 			player_moving = 1 - self.playerJustMoved
 		else:
 			player_moving = 0
 		if not self.players_alive[player_moving]:
-			return []
-		if self.last_action[player_moving] is not None:
-			return list(Actions.difference({self._opposite_action(self.last_action[player_moving])}))
-		else:
-			return list(Actions)
+			return ()
+		last_action = self.last_action[player_moving]
+		return OPPOSITE_MOVES[last_action] if last_action is not None else ALL_MOVES
 
 	def get_result(self, playerjm):
 		""" Get the game result from the viewpoint of playerjm.
@@ -212,20 +300,41 @@ class GameState:
 		# TODO: implement heuristics
 		return self.scores[playerjm]
 
-	def _collides_with_player(self, position: Position) -> bool:
-		for player in self.players:
-			if position in player:
-				return True
-		return False
+	def _cell(self, position: Position) -> int:
+		return (position.x + 1) * self.stride + position.y + 1
+
+	def _position(self, cell: int) -> Position:
+		x, y = divmod(cell, self.stride)
+		return Position(x - 1, y - 1)
+
+	def _collides_with_player(self, cell: int) -> bool:
+		""" Whether any body occupies cell, a single bit test; the body deques are never scanned.
+		"""
+		return bool(self.occ_bits >> cell & 1)
 
-	def _opposite_action(self, action: Vector) -> Vector:
-		return Vector(-action.xdir, -action.ydir)
+	def _move_body(self, player_moving: int, new_head: int) -> int:
+		""" Move the body of player_moving onto new_head and return the evicted tail.
+		"""
+		player = self.bodies[player_moving]
+		player.appendleft(new_head)
+		tail = player.pop()
+		self.occ_bits ^= (1 << new_head) | (1 << tail)
+		return tail
 
+	def _unmove_body(self, player_moving: int, tail: int) -> int:
+		""" Move the body of player_moving back onto its evicted tail and return the dropped head.
+		"""
+		player = self.bodies[player_moving]
+		head = player.popleft()
+		player.append(tail)
+		self.occ_bits ^= (1 << head) | (1 << tail)
+		return head
 
 	def __repr__(self):
 		""" Don't need this - but good style.
 		"""
-		return f'moved: {self.playerJustMoved}, players: {self.players}, score: {self.scores}, last_action: {self.last_action}'
+		players = [[self._position(cell) for cell in body] for body in self.bodies]
+		return f'moved: {self.playerJustMoved}, players: {players}, score: {self.scores}, last_action: {self.last_action}'
 
 
 class OXOState:
@@ -285,13 +394,15 @@ class Node:
 	""" A node in the game tree. Note wins is always from the viewpoint of playerJustMoved.
 		Crashes if state not specified.
 	"""
+	__slots__ = ('move', 'parentNode', 'childNodes', 'wins', 'visits', 'untriedMoves', 'playerJustMoved')
+
 	def __init__(self, move = None, parent = None, state = None):
 		self.move = move # the move that got us to this node - "None" for the root node
 		self.parentNode = parent # "None" for the root node
 		self.childNodes = []
 		self.wins = 0
 		self.visits = 0
-		self.untriedMoves = state.get_moves() # future child nodes
+		self.untriedMoves = list(state.get_moves()) # future child nodes, copied as get_moves returns shared tuples
 		self.playerJustMoved = state.playerJustMoved # the only part of the state that the Node needs later
 
 	def uct_select_child(self):
@@ -301,8 +412,10 @@ class Node:
 		"""
 		max_value = float('-inf')
 		max_node = 0
+		two_log_n = 2.0 * log(self.visits)
 		for c in self.childNodes:
-			value = c.wins/c.visits + sqrt(2*log(self.visits)/c.visits)
+			visits = c.visits
+			value = c.wins/visits + sqrt(two_log_n/visits)
 			if value > max_value:
 				max_value = value
 				max_node = c
@@ -345,51 +458,127 @@ class Node:
 		return s
 
 
-def UCT(rootstate, itermax, maxdepth, verbose = False):
+# The typed GameState is used when it is built, the int bitset GameState otherwise
+State = GameState
+if gamestate is not None:
+	State = gamestate.GameState
+
+
+def uct_search(rootstate, itermax, maxdepth):
 	""" Conduct a UCT search for itermax iterations starting from rootstate.
-		Return the best move from the rootstate.
+		Return the root node of the search tree.
 		Assumes 2 alternating players (player 1 starts), with game results in the range [0.0, 1.0]."""
-	# TODO: iterate until timeout, drop itermax
 	root_node = Node(state = rootstate)
-	start_time = time.monotonic()
+	state = rootstate.clone() # searched in place, every iteration undoes its moves at the end
+	undo = []
 
 	for i in range(itermax):
 		node = root_node
-		state = rootstate.clone()
 
 		# Select
 		while node.untriedMoves == [] and node.childNodes != []: # node is fully expanded and non-terminal
 			node = node.uct_select_child()
-			state.do_move(node.move)
+			undo.append(state.do_move(node.move))
 
 		# Expand
 		if node.untriedMoves: # if we can expand (i.e. state/node is non-terminal)
 			m = random.choice(node.untriedMoves)
-			state.do_move(m)
+			undo.append(state.do_move(m))
 			node = node.add_child(m, state) # add child and descend tree
 
-		# Rollout - this can often be made orders of magnitude quicker using a state.GetRandomMove() function
-		for j in range(maxdepth):
-			try:
-				# TODO: use heuristics for selection?
-				# TODO: cut bad branches
-				state.do_move(random.choice(state.get_moves()))
-			except IndexError:
-				break # while state is non-terminal
+		# Rollout
+		# TODO: use heuristics for selection?
+		# TODO: cut bad branches
+		undo.extend(state.rollout(maxdepth))
 
 		# Back-propagate
 		while node is not None: # back-propagate from the expanded node and work back to the root node
 			node.update(state.get_result(node.playerJustMoved)) # state is terminal. Update node with result from POV of node.playerJustMoved
 			node = node.parentNode
 
+		# Unwind back to the root state
+		while undo:
+			state.undo_move(undo.pop())
+
+	return root_node
+
+
+def UCT(rootstate, itermax, maxdepth, verbose = False):
+	""" Conduct a UCT search for itermax iterations starting from rootstate.
+		Return the best move from the rootstate.
+		Assumes 2 alternating players (player 1 starts), with game results in the range [0.0, 1.0]."""
+	# TODO: iterate until timeout, drop itermax
+	start_time = time.monotonic()
+	root_node = uct_search(rootstate, itermax, maxdepth)
+
 	# Output some information about the tree - can be omitted
 	if verbose:
 		print(root_node.tree_to_string(0))
 		print(f'Timing: {time.monotonic() - start_time}s')
-	else:
+	elif DEBUG:
 		print(root_node.children_to_string())
 
-	return sorted(root_node.childNodes, key = lambda c: c.visits)[-1].move # return the move that was most visited
+	return max(root_node.childNodes, key = lambda c: c.visits).move # return the move that was most visited
+
+
+PROCESSES = os.cpu_count() or 1
+_pool = None
+
+
+def _get_pool():
+	""" Return the worker pool for parallel_UCT, it is started on first use and kept for the whole game.
+	"""
+	global _pool
+	if _pool is None:
+		# Forked workers, run_robot.py has no __main__ guard and spawned ones would re-run it
+		_pool = multiprocessing.get_context('fork').Pool(PROCESSES)
+		atexit.register(_close_pool)
+	return _pool
+
+
+def _close_pool():
+	""" Stop the workers of parallel_UCT, registered to run at exit.
+	"""
+	global _pool
+	if _pool is not None:
+		_pool.terminate()
+		_pool.join()
+		_pool = None
+
+
+def _uct_worker(rootstate, itermax, maxdepth, seed):
+	""" Run one independent UCT search in a worker process and return the visits of the root children.
+	"""
+	# Forked workers inherit the random state of the parent, so every tree needs its own seed
+	random.seed(seed)
+	if gamestate is not None:
+		gamestate.seed(seed)
+	root_node = uct_search(rootstate, itermax, maxdepth)
+	return {c.move: c.visits for c in root_node.childNodes}
+
+
+def parallel_UCT(rootstate, itermax, maxdepth, verbose = False):
+	""" Root-parallel UCT: every process searches its own tree for itermax iterations and the
+		visit counts of the root children are summed up. Return the most visited move.
+		Falls back to a plain UCT search when there is only one CPU.
+	"""
+	if PROCESSES < 2:
+		return UCT(rootstate, itermax, maxdepth, verbose)
+
+	start_time = time.monotonic()
+	tasks = [(rootstate, itermax, maxdepth, random.getrandbits(32)) for _ in range(PROCESSES)]
+	visits: Dict[Vector, int] = {}
+	for child_visits in _get_pool().starmap(_uct_worker, tasks):
+		for move, n in child_visits.items():
+			visits[move] = visits.get(move, 0) + n
+
+	if verbose:
+		print(visits)
+		print(f'Timing: {time.monotonic() - start_time}s')
+	elif DEBUG:
+		print(visits)
+
+	return max(visits, key = visits.get) # return the move that was most visited
 
 
 if __name__ == '__main__':
@@ -0,0 +1,12 @@
+""" Builds the optional typed GameState extension in place:
+
+	python setup.py build_ext --inplace
+"""
+from setuptools import setup
+from Cython.Build import cythonize
+
+
+setup(
+	name = 'snake-ai',
+	ext_modules = cythonize(['gamestate.pyx']),
+)